@@ -20,10 +20,22 @@ Simple usage example (note that you just need the auth_token):
 > from thirdpresence import Thirdpresence
 > tpr = Thirdpresence(auth_token)
 > video_metadata_list = tpr.get_videos()
+
+Requests can be spread over several service endpoints by giving a list
+of hosts, optionally with their own path prefix:
+
+> tpr = Thirdpresence(auth_token, host=["api1.example.com",
+>                                       "api2.example.com/thirdpresence"],
+>                     health_check_interval=15)
+> tpr.get_host_stats()
 '''
 
+import heapq
 import json
+import Queue
 import requests  # install by: "pip install requests"
+import threading
+import time
 import types
 
 ACTIONS = {
@@ -63,6 +75,304 @@ ACTIONS = {
     "getVASTCompanionAds": ["GET", "vast", "03-13"],
 }
 
+# Cheap authenticated action used for the health checks of the hosts.
+HEALTH_CHECK_ACTION = "listCategories"
+
+# The key identifying each kind of object whose state can be tracked.
+TRACKED_OBJECTS = {
+    "video": "videoid",
+    "category": "categoryid",
+    "linear_vast_ad": "adid",
+    "vast_companion_ad": "companionid",
+}
+
+STATE_READING_ACTIONS = {
+    # ACTION: KIND OF THE OBJECTS IN THE REPLY
+    "getVideos": "video",
+    "getVideoById": "video",
+    "getVideosByDesc": "video",
+    "getVideosByCategory": "video",
+    "insertVideo": "video",
+    "stitchVideos": "video",
+    "listCategories": "category",
+    "addVideoCategory": "category",
+    "insertLinearVASTAd": "linear_vast_ad",
+    "getLinearVASTAdById": "linear_vast_ad",
+    "getLinearVASTAds": "linear_vast_ad",
+    "insertVASTCompanionAd": "vast_companion_ad",
+    "getVASTCompanionAdById": "vast_companion_ad",
+    "getVASTCompanionAds": "vast_companion_ad",
+}
+
+STATE_REMOVING_ACTIONS = {
+    # ACTION: [KIND OF THE REMOVED OBJECT, PARAM WITH ITS KEY]
+    "deleteVideo": ["video", "videoId"],
+    "deleteCategory": ["category", "categoryId"],
+    "deleteLinearVASTAd": ["linear_vast_ad", "adid"],
+    "deleteVASTCompanionAd": ["vast_companion_ad", "companionid"],
+}
+
+class _Endpoint(object):
+    '''A single service endpoint, i.e. a host with an optional path prefix,
+    and the statistics observed for it.
+    '''
+    def __init__(self, host, path_prefix=None):
+        self.host = host
+        self.path_prefix = path_prefix
+        self.outstanding = 0
+        self.latency = None  # Moving average of response times in seconds.
+        self.requests = 0
+        self.errors = 0
+        self.probe_latency = None  # Same for the health checks.
+        self.probes = 0
+        self.probe_errors = 0
+        self.consecutive_errors = 0
+        self.last_failure = None
+        self.ejections = 0
+        self.ejected_until = None
+
+    def base_url(self, protocol):
+        '''Gives the URL of the endpoint up to the API version part.
+        '''
+        the_path = ""
+        if self.path_prefix:
+            the_path += self.path_prefix.strip("/") + "/"
+        return "{0}://{1}/{2}".format(protocol, self.host, the_path)
+
+    def is_ejected(self, now):
+        return self.ejected_until is not None and self.ejected_until > now
+
+
+class EndpointPool(object):
+    '''A pool of service endpoints used by the Thirdpresence client.
+
+    Every request is sent to the endpoint with the lowest observed latency
+    weighted by its outstanding requests, plus a penalty for each of its
+    consecutive failures. The penalty fades out within FAILURE_DECAY
+    seconds of the last failure, so a failed endpoint is tried again.
+    Endpoints failing max_failures times in a row are ejected for
+    eject_seconds. After that the next request goes to the endpoint on
+    probation: a single further failure ejects it again. If
+    health_check_interval is set, a background thread probes all the
+    endpoints and re-admits recovered ones early.
+    '''
+    # Weight of the latest sample in the latency moving average.
+    LATENCY_ALPHA = 0.3
+
+    # Seconds added to the score of an endpoint per consecutive failure.
+    FAILURE_PENALTY = 10.0
+
+    # Seconds in which the failure penalty decreases linearly to zero.
+    FAILURE_DECAY = 30.0
+
+    def __init__(self, hosts, path_prefix=None,
+                 max_failures=3, eject_seconds=30,
+                 health_check_interval=None, health_check_timeout=5,
+                 logger=None, probe=None):
+        """
+        @param hosts: A host name or a list of them. A host name may contain
+                      a path prefix of its own, e.g. "somehost/api". Hosts
+                      without one use the common path_prefix.
+        @param path_prefix: Additional path part to be added after URL host part.
+        @param max_failures: Consecutive failures after which a host is ejected.
+        @param eject_seconds: How long an ejected host is left unused.
+        @param health_check_interval: Seconds between background health
+                                      checks, or None for no health checks.
+        @param health_check_timeout: Timeout in seconds for a health check.
+        @param logger: Logging Logger instance with methods like debug and info.
+        @param probe: Function making a health check request to the endpoint
+                      given as its argument, raising an error on failure.
+                      Health checks are made only if a probe is given.
+        """
+        if isinstance(hosts, types.StringTypes):
+            hosts = [hosts]
+        assert hosts, "Give at least one host"
+        self.endpoints = []
+        for host in hosts:
+            host, _, own_prefix = host.partition("/")
+            self.endpoints.append(_Endpoint(host, own_prefix or path_prefix))
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        self.logger = logger
+        self.probe = probe
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._health_thread = None
+
+    def acquire(self):
+        '''Selects the endpoint for a new request. The request must be
+        reported back with release().
+        '''
+        with self._lock:
+            now = time.time()
+            candidates = [e for e in self.endpoints if not e.is_ejected(now)]
+            expired = [e for e in candidates if e.ejected_until is not None]
+            if expired:
+                # One trial request for an endpoint whose ejection is over.
+                endpoint = expired[0]
+            elif candidates:
+                endpoint = min(candidates, key=lambda e: self._score(e, now))
+            else:
+                # All ejected, try the one which would be re-admitted first.
+                endpoint = min(self.endpoints, key=lambda e: e.ejected_until)
+            if endpoint.ejected_until is not None and not endpoint.is_ejected(now):
+                self._readmit(endpoint, probation=True)
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def release(self, endpoint, elapsed, ok):
+        '''Records the result of a request made with acquire().
+
+        @param endpoint: The endpoint given by acquire().
+        @param elapsed: The duration of the request in seconds.
+        @param ok: False if the endpoint failed to serve the request.
+        '''
+        with self._lock:
+            endpoint.outstanding -= 1
+            self._record(endpoint, elapsed, ok)
+
+    def check_health(self):
+        '''Probes every endpoint once. An endpoint is unhealthy if the probe
+        fails to connect, or gets a 404, a 5XX or a reply which is not JSON.
+        Probes are kept out of the request statistics.
+        '''
+        for endpoint in self.endpoints:
+            start = time.time()
+            try:
+                self.probe(endpoint)
+                ok = True
+            except (requests.RequestException, ResourceNotFoundError,
+                    InternalServerError), e:
+                if self.logger:
+                    self.logger.warning("Health check failed for {0}: {1}".format(
+                                            endpoint.host, e))
+                ok = False
+            except ThirdpresenceAPIError:
+                ok = True  # The service itself answered with an API error.
+            except Exception, e:
+                if self.logger:
+                    self.logger.warning("Health check of {0} raised {1!r}".format(
+                                            endpoint.host, e))
+                ok = False
+            with self._lock:
+                self._record_probe(endpoint, time.time() - start, ok)
+
+    def start_health_checks(self):
+        '''Starts the background health checks, if an interval is set.
+        '''
+        if not self.health_check_interval or not self.probe \
+               or self._health_thread:
+            return
+        self._stop_event.clear()
+        self._health_thread = threading.Thread(target=self._health_loop,
+                                               name="thirdpresence-health")
+        self._health_thread.daemon = True
+        self._health_thread.start()
+
+    def stop_health_checks(self):
+        '''Stops the background health checks.
+        '''
+        self._stop_event.set()
+        if self._health_thread:
+            self._health_thread.join()
+            self._health_thread = None
+
+    def stats(self):
+        '''Gives the statistics of every endpoint.
+
+        @return List of dicts, one per endpoint.
+        '''
+        with self._lock:
+            now = time.time()
+            return [{"host": e.host,
+                     "path_prefix": e.path_prefix,
+                     "requests": e.requests,
+                     "errors": e.errors,
+                     "outstanding": e.outstanding,
+                     "latency": e.latency,
+                     "probes": e.probes,
+                     "probe_errors": e.probe_errors,
+                     "probe_latency": e.probe_latency,
+                     "ejections": e.ejections,
+                     "ejected": e.is_ejected(now)}
+                    for e in self.endpoints]
+
+    def _health_loop(self):
+        while not self._stop_event.is_set():
+            self._stop_event.wait(self.health_check_interval)
+            if not self._stop_event.is_set():
+                try:
+                    self.check_health()
+                except Exception, e:
+                    # Keep the health checks running whatever happens.
+                    if self.logger:
+                        self.logger.warning("Health checks failed: {0!r}".format(e))
+
+    def _score(self, endpoint, now):
+        '''Gives the sort key of an endpoint for acquire(). An endpoint
+        without latency samples is assumed to be as fast as the average
+        endpoint, and is preferred only over equally scored ones.
+        '''
+        latency = endpoint.latency
+        if latency is None:
+            measured = [e.latency for e in self.endpoints if e.latency is not None]
+            latency = sum(measured) / len(measured) if measured else 0.0
+        score = latency * (endpoint.outstanding + 1)
+        if endpoint.last_failure is not None:
+            decay = max(0.0, 1 - (now - endpoint.last_failure) / self.FAILURE_DECAY)
+            score += endpoint.consecutive_errors * self.FAILURE_PENALTY * decay
+        return score, endpoint.latency is not None, endpoint.outstanding
+
+    def _record(self, endpoint, elapsed, ok):
+        if ok:
+            endpoint.consecutive_errors = 0
+            endpoint.latency = self._average(endpoint.latency, elapsed)
+        else:
+            endpoint.errors += 1
+            self._fail(endpoint)
+
+    def _record_probe(self, endpoint, elapsed, ok):
+        endpoint.probes += 1
+        if ok:
+            endpoint.probe_latency = self._average(endpoint.probe_latency,
+                                                   elapsed)
+            if endpoint.ejected_until is not None:
+                self._readmit(endpoint)
+            endpoint.consecutive_errors = 0
+        else:
+            endpoint.probe_errors += 1
+            self._fail(endpoint)
+
+    def _average(self, average, sample):
+        if average is None:
+            return sample
+        return average + self.LATENCY_ALPHA * (sample - average)
+
+    def _fail(self, endpoint):
+        endpoint.consecutive_errors += 1
+        endpoint.last_failure = time.time()
+        if endpoint.consecutive_errors >= self.max_failures \
+               and not endpoint.is_ejected(time.time()):
+            endpoint.ejected_until = time.time() + self.eject_seconds
+            endpoint.ejections += 1
+            if self.logger:
+                self.logger.warning("Ejecting host {0} for {1} seconds".format(
+                                        endpoint.host, self.eject_seconds))
+
+    def _readmit(self, endpoint, probation=False):
+        endpoint.ejected_until = None
+        endpoint.last_failure = None
+        if probation:
+            endpoint.consecutive_errors = self.max_failures - 1
+        else:
+            endpoint.consecutive_errors = 0
+        if self.logger:
+            self.logger.info("Re-admitting host {0}".format(endpoint.host))
+
+
 class Thirdpresence(object):
     """A client for the ThirdPresence API.
 
@@ -71,11 +381,14 @@ class Thirdpresence(object):
     """
     def __init__(self, auth_token, host="api.thirdpresence.com",
                  protocol="http", forced_version=None,
-                 path_prefix=None, logger=None):
+                 path_prefix=None, logger=None, timeout=None,
+                 health_check_interval=None, track_state=False):
         """
         @param auth_token: You get the auth_token after registering with
                            the service. Used for authentication.
-        @param host: The host name for the Thirdpresence service.
+        @param host: The host name for the Thirdpresence service, or a list
+                     of host names to spread the requests over. A host name
+                     may contain a path prefix of its own, e.g. "somehost/api".
         @param protocol: The protocol to use for the calls to the service.
                          Set it to 'https' if you want to use TLS.
         @param forced_version: Set this to a version number, if you want
@@ -84,16 +397,188 @@ class Thirdpresence(object):
                             for every made request.
         @param logger: Logging Logger instance with methods like debug and info.
                        Pass logger instance for verbose output.
+        @param timeout: Timeout in seconds for the requests, or None to wait
+                        for ever.
+        @param health_check_interval: Seconds between background health checks
+                                      of the hosts, or None to disable them.
+        @param track_state: Set this to True to remember the last known state
+                            of videos, categories, VAST ads and companions.
+                            The update methods then skip the writes which
+                            would not change anything, and return the known
+                            state instead of the reply of the service. The
+                            known state is a dict with lowercased keys,
+                            merged from the replies and the sent updates.
         """
         self.auth_token = auth_token
-        self.host = host
         self.protocol = protocol
         self.forced_version = forced_version
-        self.path_prefix = path_prefix
         self.logger = logger
+        self.timeout = timeout
+        self.pool = EndpointPool(host, path_prefix,
+                                 health_check_interval=health_check_interval,
+                                 logger=logger, probe=self._probe)
+        self.pool.start_health_checks()
+        self._hosts = host
+        self._path_prefix = path_prefix
+        self.track_state = track_state
+        self.writes_sent = 0
+        self.writes_avoided = 0
+        self._known_state = {}
+        self._state_lock = threading.Lock()
+
+    @property
+    def host(self):
+        '''The first host of the pool. Assigning a host name, or a list
+        of them, replaces the hosts of the pool.
+        '''
+        return self.pool.endpoints[0].host
+
+    @host.setter
+    def host(self, host):
+        self._rebuild_pool(host, self._path_prefix)
+
+    @property
+    def path_prefix(self):
+        '''The path prefix of the first host of the pool. Assigning it
+        sets the prefix of the hosts without a prefix of their own.
+        '''
+        return self.pool.endpoints[0].path_prefix
+
+    @path_prefix.setter
+    def path_prefix(self, path_prefix):
+        self._rebuild_pool(self._hosts, path_prefix)
+
+    def _rebuild_pool(self, hosts, path_prefix):
+        '''Replaces the endpoint pool with one for the given hosts, keeping
+        the settings of the current pool. The host statistics start over.
+        '''
+        old_pool = self.pool
+        old_pool.stop_health_checks()
+        self.pool = EndpointPool(hosts, path_prefix, old_pool.max_failures,
+                                 old_pool.eject_seconds,
+                                 old_pool.health_check_interval,
+                                 old_pool.health_check_timeout,
+                                 old_pool.logger, old_pool.probe)
+        self._hosts = hosts
+        self._path_prefix = path_prefix
+        self.pool.start_health_checks()
+
+    def close(self):
+        '''Stops the background health checks of the hosts.
+        '''
+        self.pool.stop_health_checks()
+
+    def get_host_stats(self):
+        '''Gets the statistics collected for each host.
+
+        The health checks are counted separately from the requests in
+        probes, probe_errors and probe_latency.
+
+        @return List of dicts with keys: host, path_prefix, requests, errors,
+                outstanding, latency, probes, probe_errors, probe_latency,
+                ejections and ejected.
+        '''
+        return self.pool.stats()
+
+    def get_write_stats(self):
+        '''Gets the counts of the update requests sent and of those
+        skipped because of no changes. Skipping is done only when the
+        client was created with track_state=True.
+
+        @return Dict with keys: sent, avoided.
+        '''
+        return {"sent": self.writes_sent, "avoided": self.writes_avoided}
+
+    def forget_state(self):
+        '''Forgets the known state of all objects, e.g. after they have
+        been modified outside of this client.
+        '''
+        with self._state_lock:
+            self._known_state.clear()
+
+    def _remember(self, kind, json_data):
+        '''Stores the state of the objects in a reply, merging it into
+        the state already known.
+        '''
+        if isinstance(json_data, dict):
+            json_data = [json_data]
+        elif not isinstance(json_data, list):
+            return
+        key = TRACKED_OBJECTS[kind]
+        with self._state_lock:
+            for item in json_data:
+                if not isinstance(item, dict):
+                    continue
+                fields = dict((k.lower(), v) for k, v in item.items())
+                if fields.get(key) is None:
+                    continue
+                state = self._known_state.setdefault((kind, str(fields[key])), {})
+                state.update(fields)
+
+    def _forget(self, kind, object_id=None):
+        '''Forgets the state of an object, or of all objects of a kind.
+        '''
+        with self._state_lock:
+            if object_id is not None:
+                self._known_state.pop((kind, str(object_id)), None)
+            else:
+                for state_key in [k for k in self._known_state if k[0] == kind]:
+                    del self._known_state[state_key]
+
+    def _check_write(self, kind, fields):
+        '''Compares the fields of an update with the last known state of
+        the object. If nothing differs, the update is counted as avoided.
+
+        @return Tuple of the changed fields, or None if the state of the
+                object is not known, and of a copy of the known state if
+                the update must be skipped, or None otherwise.
+        '''
+        if not self.track_state:
+            return None, None
+        object_id = None
+        for k, v in fields.items():
+            if k.lower() == TRACKED_OBJECTS[kind]:
+                object_id = v
+        if object_id is None:
+            return None, None
+        with self._state_lock:
+            state = self._known_state.get((kind, str(object_id)))
+            if state is None:
+                return None, None
+            changed = dict((k, v) for k, v in fields.items()
+                           if k.lower() not in state or state[k.lower()] != v)
+            if changed:
+                return changed, None
+            self.writes_avoided += 1
+            known = dict(state)
+        if self.logger:
+            self.logger.info("Skipping update of unchanged {0} {1}".format(
+                                 kind, object_id))
+        return changed, known
 
-    def _make_req(self, action, params=None, data=None):
+    def _tracked_write(self, kind, fields, action, params=None, data=None):
+        '''Makes an update request and stores the sent fields as the
+        known state of the object.
+        '''
+        with self._state_lock:
+            self.writes_sent += 1
+        _, _, _, json_data = self._make_req(action, params, data)
+        if self.track_state:
+            self._remember(kind, fields)
+            self._remember(kind, json_data)
+        return json_data
+
+    def _probe(self, endpoint):
+        '''Makes a health check request to the given endpoint.
+        '''
+        self._make_req(HEALTH_CHECK_ACTION, endpoint=endpoint,
+                       timeout=self.pool.health_check_timeout)
+
+    def _make_req(self, action, params=None, data=None, endpoint=None,
+                  timeout=None):
         '''Makes a HTTP request into the ThirdPresence API.
+        The request goes to the given endpoint bypassing the endpoint
+        selection and statistics, if an endpoint is given.
         '''
         assert action in ACTIONS, "Invalid action: {0}".format(action)
         if params:
@@ -113,12 +598,6 @@ class Thirdpresence(object):
             assert False, \
                 "Invalid HTTP method in actions table: {0}".format(method)
 
-        the_path = ""
-        if self.path_prefix:
-            the_path += self.path_prefix.strip("/") + "/"
-        the_path += "{0}/{1}".format(version, namespace)
-        the_url = "{0}://{1}/{2}/".format(self.protocol, self.host, the_path)
-
         params["Action"] = action
         params["authToken"] = self.auth_token
         params["version"] = version
@@ -134,6 +613,12 @@ class Thirdpresence(object):
         elif data:
             assert False, "Invalid data given of type: {0}".format(type(data))
 
+        pooled = endpoint is None
+        if pooled:
+            endpoint = self.pool.acquire()
+        the_url = "{0}{1}/{2}/".format(endpoint.base_url(self.protocol),
+                                       version, namespace)
+
         if self.logger:
             data_len = 0
             if request_data:
@@ -141,7 +626,16 @@ class Thirdpresence(object):
             self.logger.info("Making request: {0} {1} params={2} headers={3} data_len={4}".format(
                                  method, the_url, params, headers, data_len))
 
-        r = func(the_url, params=params, headers=headers, data=request_data)
+        start = time.time()
+        try:
+            r = func(the_url, params=params, headers=headers, data=request_data,
+                     timeout=timeout or self.timeout)
+        except requests.RequestException:
+            if pooled:
+                self.pool.release(endpoint, time.time() - start, False)
+            raise
+        if pooled:
+            self.pool.release(endpoint, time.time() - start, r.status_code < 500)
 
         # pylint: disable-msg=E1103
         if callable(r.json):
@@ -158,6 +652,12 @@ class Thirdpresence(object):
             self.logger.info("Response: status_code={0}, reason={1}, headers={2}, json_data=\n{3}".format(
                                  r.status_code, r.reason, r.headers, the_json_data))
         self._validate_status(r.status_code, r.reason, the_json_data)
+
+        if self.track_state and action in STATE_READING_ACTIONS:
+            self._remember(STATE_READING_ACTIONS[action], the_json_data)
+        elif self.track_state and action in STATE_REMOVING_ACTIONS:
+            kind, param = STATE_REMOVING_ACTIONS[action]
+            self._forget(kind, params.get(param))
         return r.status_code, r.reason, r.headers, the_json_data
 
     def _validate_status(self, status_code, reason=None, json_data=None):
@@ -313,12 +813,19 @@ class Thirdpresence(object):
         You must pass the video metadata as a dictionary and it will
         be encoded as JSON payload into the HTTP request.
 
+        If the client tracks state and none of the given fields differ
+        from the last known state of the video, no request is made and
+        the known state is returned instead.
+
         @param video_metadata: A dictionary with the video metadata.
-        @return The metadata of the added video in JSON format.
+        @return The metadata of the added video in JSON format, or the known
+                state of the video if the update was skipped.
         '''
-        _, _, _, json_data = \
-                self._make_req("updateVideoData", None, video_metadata)
-        return json_data
+        _, known = self._check_write("video", video_metadata)
+        if known is not None:
+            return known
+        return self._tracked_write("video", video_metadata,
+                                   "updateVideoData", None, video_metadata)
 
     def list_categories(self):
         '''Gets the categories for an account.
@@ -376,17 +883,34 @@ class Thirdpresence(object):
         @param name: The new name for the category.
         @param provider_id: Customer's own ID, the provider_id for videos.
         @param source_url: Source for the video feed. See the comment above.
-        @return Added category metadata in JSON format.
+        @return Added category metadata in JSON format, or the known state
+                of the category if the update was skipped.
+
+        If the client tracks state, only the fields differing from the last
+        known state of the category are sent, and no request is made at
+        all if nothing differs. The known state is returned in that case.
         '''
-        params = {"categoryId": category_id}
+        fields = {"categoryid": category_id}
         if name:
-            params["name"] = name
+            fields["name"] = name
         if provider_id:
-            params["providerId"] = provider_id
+            fields["providerid"] = provider_id
         if source_url:
+            fields["sourceurl"] = source_url
+        changed, known = self._check_write("category", fields)
+        if known is not None:
+            return known
+        if changed is None:
+            changed = fields
+
+        params = {"categoryId": category_id}
+        if "name" in changed:
+            params["name"] = name
+        if "providerid" in changed:
+            params["providerId"] = provider_id
+        if "sourceurl" in changed:
             params["sourceurl"] = source_url
-        _, _, _, json_data = self._make_req("updateCategory", params)
-        return json_data
+        return self._tracked_write("category", fields, "updateCategory", params)
 
     def add_token(self, video_id, content_auth_token, provider_id=None):
         '''Adds an authorization token for a video.
@@ -531,12 +1055,19 @@ class Thirdpresence(object):
         See example of the VAST ad object structure from method:
         "insert_linear_vast_ad".
 
+        If the client tracks state and none of the given fields differ
+        from the last known state of the ad, no request is made and
+        the known state is returned instead.
+
         @param vast_ad_metadata: A dictionary with the ad metadata.
-        @return The metadata of the updated VAST ad in JSON format.
+        @return The metadata of the updated VAST ad in JSON format, or the
+                known state of the ad if the update was skipped.
         '''
-        _, _, _, json_data = \
-                self._make_req("updateLinearVASTAd", None, vast_ad_metadata)
-        return json_data
+        _, known = self._check_write("linear_vast_ad", vast_ad_metadata)
+        if known is not None:
+            return known
+        return self._tracked_write("linear_vast_ad", vast_ad_metadata,
+                                   "updateLinearVASTAd", None, vast_ad_metadata)
 
     def delete_linear_vast_ad(self, adid):
         '''Deletes an existing VAST advertisement.
@@ -600,12 +1131,20 @@ class Thirdpresence(object):
         See example of the VAST ad object structure from method:
         "insert_vast_companion_ad".
 
+        If the client tracks state and none of the given fields differ
+        from the last known state of the companion, no request is made and
+        the known state is returned instead.
+
         @param companion_metadata: A dictionary with the companion metadata.
-        @return The metadata of the updated Companion in JSON format.
+        @return The metadata of the updated Companion in JSON format, or the
+                known state of the companion if the update was skipped.
         '''
-        _, _, _, json_data = \
-                self._make_req("updateVASTCompanionAd", None, companion_metadata)
-        return json_data
+        _, known = self._check_write("vast_companion_ad", companion_metadata)
+        if known is not None:
+            return known
+        return self._tracked_write("vast_companion_ad", companion_metadata,
+                                   "updateVASTCompanionAd", None,
+                                   companion_metadata)
 
     def delete_vast_companion_ad(self, companionid):
         '''Deletes an existing VAST Companion.
@@ -635,6 +1174,392 @@ class Thirdpresence(object):
         return json_data
 
 
+class _WorkerPool(object):
+    '''Runs functions in a fixed number of threads and collects their
+    outcomes as (tag, result, error) tuples.
+    '''
+    # Seconds close() waits for the threads to finish their current tasks.
+    CLOSE_TIMEOUT = 5
+
+    def __init__(self, size):
+        assert size > 0, "Invalid amount of workers: {0}".format(size)
+        self.tasks = Queue.Queue()
+        self.results = Queue.Queue()
+        self.threads = []
+        for _ in range(size):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, tag, func, *args):
+        self.tasks.put((tag, func, args))
+
+    def get(self, timeout):
+        '''Gives the next outcome, or raises Queue.Empty on timeout.
+        '''
+        return self.results.get(timeout=timeout)
+
+    def close(self, timeout=None):
+        '''Drops the tasks not yet started and stops the threads. Waits at
+        most timeout seconds, CLOSE_TIMEOUT by default, for tasks still
+        running, e.g. requests without a timeout, and leaves them behind
+        in their daemon threads.
+        '''
+        try:
+            while True:
+                self.tasks.get_nowait()
+        except Queue.Empty:
+            pass
+        for _ in self.threads:
+            self.tasks.put(None)
+        if timeout is None:
+            timeout = self.CLOSE_TIMEOUT
+        deadline = time.time() + timeout
+        for thread in self.threads:
+            # Idle threads exit at once, a short grace lets them do so.
+            thread.join(max(0.01, deadline - time.time()))
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            tag, func, args = task
+            try:
+                self.results.put((tag, func(*args), None))
+            except Exception, e:
+                self.results.put((tag, None, e))
+
+
+def _lower_keys(json_data):
+    if isinstance(json_data, dict):
+        return dict((str(k).lower(), v) for k, v in json_data.items())
+    return {}
+
+
+class StitchPipeline(object):
+    '''Stitches ad videos, e.g. prerolls, to content videos.
+
+    Videos not yet in the platform are inserted first. Each pair is
+    stitched as soon as get_delivery_status reports both of its videos
+    ACTIVE, without waiting for the other pairs. All the requests are
+    made through max_workers concurrent threads.
+
+    Example:
+
+    > pipeline = StitchPipeline(tpr, max_workers=4)
+    > results = pipeline.run({"bunny": 300001},
+    >                        {"preroll": {"name": "Preroll",
+    >                                     "sourceurl": "http://somehost/AD.mp4",
+    >                                     "categoryid": 1179}},
+    >                        stitch_metadata={"categoryid": 1179})
+    '''
+    # Statuses after which a video will never become ACTIVE.
+    FAILED_STATUSES = ("INACTIVE", "ERROR", "REMOVED")
+
+    def __init__(self, client, max_workers=4, poll_interval=10,
+                 ready_timeout=3600):
+        """
+        @param client: A Thirdpresence instance used for the requests.
+        @param max_workers: The maximum amount of concurrent requests.
+        @param poll_interval: Seconds between the delivery status checks
+                              of a video which is not yet ACTIVE.
+        @param ready_timeout: Seconds to wait for a video to become ACTIVE.
+        """
+        self.client = client
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        self.ready_timeout = ready_timeout
+
+    def run(self, sources, ads, pairing=None, stitch_metadata=None):
+        '''Inserts the missing videos and stitches the pairs.
+
+        The sources and ads are dicts keyed by names of your choice. Each
+        value is either the ID of a video already in the platform, or a
+        video metadata dict for insert_video. A metadata dict with key
+        'videoid' refers to an existing video.
+
+        @param sources: Dict of content videos.
+        @param ads: Dict of ad videos.
+        @param pairing: None to stitch every source with every ad,
+                        a list of (source key, ad key) tuples, or a
+                        function taking a source key and an ad key and
+                        returning stitch metadata for the pair, or None
+                        if the pair must not be stitched.
+        @param stitch_metadata: A dictionary with stitch metadata common
+                                to all pairs, see stitch_videos.
+        @return List of dicts, one per pair, with keys: source, ad, status
+                ("STITCHED" or "FAILED"), result (the reply of
+                stitch_videos) and error.
+        '''
+        pairs = []
+        for source_key, ad_key, metadata in \
+                self._pairs(sources, ads, pairing):
+            assert source_key in sources, \
+                   "Unknown source: {0}".format(source_key)
+            assert ad_key in ads, "Unknown ad: {0}".format(ad_key)
+            the_metadata = dict(stitch_metadata or {})
+            the_metadata.update(metadata)
+            pairs.append({"source": source_key, "ad": ad_key,
+                          "metadata": the_metadata, "status": None,
+                          "result": None, "error": None})
+
+        videos = {}
+        for pair in pairs:
+            videos[("source", pair["source"])] = sources[pair["source"]]
+            videos[("ad", pair["ad"])] = ads[pair["ad"]]
+
+        pool = _WorkerPool(self.max_workers)
+        try:
+            self._schedule(pool, videos, pairs)
+        finally:
+            pool.close()
+        return [dict((k, pair[k]) for k in ("source", "ad", "status",
+                                            "result", "error"))
+                for pair in pairs]
+
+    def _pairs(self, sources, ads, pairing):
+        if pairing is None:
+            for source_key in sources:
+                for ad_key in ads:
+                    yield source_key, ad_key, {}
+        elif callable(pairing):
+            for source_key in sources:
+                for ad_key in ads:
+                    metadata = pairing(source_key, ad_key)
+                    if metadata is not None:
+                        yield source_key, ad_key, metadata
+        else:
+            for source_key, ad_key in pairing:
+                yield source_key, ad_key, {}
+
+    def _schedule(self, pool, videos, pairs):
+        logger = self.client.logger
+        state = {}  # video: [video ID, status, deadline, last error]
+        delayed = []  # heap of (time, video) for status checks
+        pending = 0
+
+        for video, spec in videos.items():
+            video_id = spec
+            if isinstance(spec, dict):
+                video_id = _lower_keys(spec).get("videoid")
+            state[video] = [video_id, None, None, None]
+            if video_id is None:
+                pool.submit(("insert", video), self.client.insert_video, spec)
+            else:
+                pool.submit(("status", video),
+                            self.client.get_delivery_status, video_id)
+            pending += 1
+
+        while pending or delayed:
+            timeout = 60
+            if delayed:
+                timeout = max(0, min(timeout, delayed[0][0] - time.time()))
+            try:
+                (kind, item), json_data, error = pool.get(timeout)
+                pending -= 1
+            except Queue.Empty:
+                kind = None
+
+            if kind == "insert":
+                state[item][0] = _lower_keys(json_data).get("videoid")
+                if error is None and state[item][0] is None:
+                    error = "No videoid in reply: {0}".format(json_data)
+                if error is not None:
+                    self._fail_video(pairs, item, error)
+                elif self._needed(pairs, item):
+                    pool.submit(("status", item),
+                                self.client.get_delivery_status, state[item][0])
+                    pending += 1
+
+            elif kind == "status":
+                video_id, _, deadline, _ = state[item]
+                if deadline is None:
+                    deadline = state[item][2] = time.time() + self.ready_timeout
+                status = json_data
+                if isinstance(status, dict):
+                    status = _lower_keys(status).get("status")
+                status = str(status).upper()
+                if error is not None:
+                    state[item][3] = error
+                    if logger:
+                        logger.warning("Delivery status check of video {0} "
+                                       "failed: {1}".format(video_id, error))
+                if error is not None and not self._is_transient(error):
+                    self._fail_video(pairs, item, error)
+                elif error is None and status == "ACTIVE":
+                    state[item][1] = status
+                    pending += self._submit_ready(pool, state, pairs)
+                elif error is None and status in self.FAILED_STATUSES:
+                    self._fail_video(pairs, item, "Video {0} is {1}".format(
+                                                      video_id, status))
+                elif time.time() >= deadline:
+                    message = "Video {0} not ACTIVE in {1} seconds".format(
+                                  video_id, self.ready_timeout)
+                    if state[item][3] is not None:
+                        message += ", last error: {0!r}".format(state[item][3])
+                    self._fail_video(pairs, item, message)
+                else:
+                    heapq.heappush(delayed,
+                                   (time.time() + self.poll_interval, item))
+
+            elif kind == "stitch":
+                item["status"] = "FAILED" if error is not None else "STITCHED"
+                item["result"] = json_data
+                item["error"] = error
+
+            # Stop polling the videos which no remaining pair waits for.
+            delayed = [d for d in delayed if self._needed(pairs, d[1])]
+            heapq.heapify(delayed)
+
+            while delayed and delayed[0][0] <= time.time():
+                _, video = heapq.heappop(delayed)
+                pool.submit(("status", video),
+                            self.client.get_delivery_status, state[video][0])
+                pending += 1
+
+    def _is_transient(self, error):
+        '''Tells whether a failed status check is worth retrying. Errors
+        like an unknown video ID fail the video at once.
+        '''
+        return isinstance(error, (requests.RequestException,
+                                  InternalServerError))
+
+    def _submit_ready(self, pool, state, pairs):
+        '''Submits the stitches of the pairs whose videos are both ACTIVE.
+        '''
+        submitted = 0
+        for pair in pairs:
+            source = state[("source", pair["source"])]
+            ad = state[("ad", pair["ad"])]
+            if pair["status"] is None \
+                   and source[1] == "ACTIVE" and ad[1] == "ACTIVE":
+                pair["status"] = "STITCHING"
+                metadata = dict(pair["metadata"])
+                metadata["sourceurl"] = str(source[0])
+                metadata["adurl"] = str(ad[0])
+                pool.submit(("stitch", pair), self.client.stitch_videos,
+                            metadata)
+                submitted += 1
+        return submitted
+
+    def _needed(self, pairs, video):
+        '''Tells whether any pair still waits for the given video.
+        '''
+        role, key = video
+        return any(pair["status"] is None and pair[role] == key
+                   for pair in pairs)
+
+    def _fail_video(self, pairs, video, error):
+        role, key = video
+        for pair in pairs:
+            if pair["status"] is None and pair[role] == key:
+                pair["status"] = "FAILED"
+                pair["error"] = error
+
+
+class CatalogCrawler(object):
+    '''Fetches the whole video catalog of an account category by category.
+
+    The categories are fetched through max_workers concurrent threads,
+    so the crawl takes about as long as the slowest category instead of
+    a single get_videos call for the whole account. Categories not
+    fetched within timeout seconds are reported as failed.
+
+    Example:
+
+    > crawler = CatalogCrawler(tpr, max_workers=8)
+    > catalog = crawler.crawl()
+    > video_metadata_list = catalog["videos"]
+    '''
+    def __init__(self, client, max_workers=8, timeout=600):
+        """
+        @param client: A Thirdpresence instance used for the requests.
+        @param max_workers: The maximum amount of concurrent requests.
+        @param timeout: Seconds to wait for all the categories, or None
+                        to wait for ever.
+        """
+        self.client = client
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+    def crawl(self, callback=None):
+        '''Fetches the videos of all the categories of the account.
+        A video appearing in several categories is returned only once.
+
+        @param callback: Optional function called with a category ID and
+                         a list of its videos not seen before, as soon as
+                         the category has been fetched.
+        @return Dict with keys: videos (list of video metadata in JSON
+                format) and failed (dict of the errors by category ID
+                for the categories which could not be fetched in time).
+        '''
+        category_ids = []
+        for category in self.client.list_categories() or []:
+            fields = _lower_keys(category)
+            category_id = fields.get("categoryid", fields.get("id"))
+            if category_id is not None and category_id not in category_ids:
+                category_ids.append(category_id)
+
+        videos = []
+        seen_ids = set()
+        failed = {}
+        remaining = set(category_ids)
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        pool = _WorkerPool(max(1, min(self.max_workers, len(category_ids))))
+        try:
+            for category_id in category_ids:
+                pool.submit(category_id, self.client.get_videos_by_category,
+                            category_id)
+            while remaining:
+                # Waiting in short steps keeps the crawl interruptible.
+                wait = 1.0
+                if deadline is not None:
+                    wait = min(wait, deadline - time.time())
+                    if wait <= 0:
+                        break
+                try:
+                    category_id, json_data, error = pool.get(wait)
+                except Queue.Empty:
+                    continue
+                remaining.discard(category_id)
+                if error is not None:
+                    if self.client.logger:
+                        self.client.logger.warning(
+                            "Failed fetching category {0}: {1}".format(
+                                category_id, error))
+                    failed[category_id] = error
+                    continue
+                if isinstance(json_data, dict):
+                    json_data = [json_data]
+                new_videos = []
+                for video in json_data or []:
+                    fields = _lower_keys(video)
+                    video_id = fields.get("videoid", fields.get("id"))
+                    if video_id is not None:
+                        if str(video_id) in seen_ids:
+                            continue
+                        seen_ids.add(str(video_id))
+                    new_videos.append(video)
+                videos.extend(new_videos)
+                if callback:
+                    callback(category_id, new_videos)
+        finally:
+            # Categories still running are past the deadline, don't wait.
+            pool.close(0 if remaining else None)
+        for category_id in remaining:
+            if self.client.logger:
+                self.client.logger.warning(
+                    "Category {0} not fetched in {1} seconds".format(
+                        category_id, self.timeout))
+            failed[category_id] = "Not fetched in {0} seconds".format(
+                                      self.timeout)
+        return {"videos": videos, "failed": failed}
+
+
 class ThirdpresenceAPIError(StandardError):
     '''All errors thrown by the Thirdpresence SDK are extended from
     this error class.'''